@@ -1,28 +1,53 @@
 #!/usr/local/bin/python3
 """Asynchronous scraping code"""
 import asyncio
-import cgi
 from contextlib import contextmanager
+import email.message
 import functools
+import math
 import os
 import pathlib
+import sys
 
 import blessings
-from bs4 import BeautifulSoup
 import progressbar
+try:
+    import lxml.etree
+    import lxml.html
+    HAVE_LXML = True
+except ImportError:
+    # Without lxml extract_zip_links falls back to BeautifulSoup's pure-Python parser
+    HAVE_LXML = False
 
 from absl import app
 from absl import flags
 from absl import logging
-import aiofiles
 import aiohttp
+try:
+    import uvloop
+except ImportError:
+    # uvloop is unavailable on some platforms (e.g. Windows), fall back to asyncio's loop
+    uvloop = None
 
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string('output_dir', 'scrape_results',
                     'Directory to write scrape output to.')
+flags.DEFINE_list('file_prefixes', ['100MB'],
+                  'Only download zip files whose names start with one of these prefixes. '
+                  'Pass an empty list to download every zip file.')
 FLAGS.verbosity = -1
 
+# Socket limit and DNS cache lifetime (seconds) for the shared connection pool
+CONNECTION_LIMIT = 32
+DNS_CACHE_TTL = 300
+# Size of the chunks read from the response body
+CHUNK_SIZE = 1 << 16
+# Yield to the event loop every this many chunks to keep downloads fair
+YIELD_EVERY_CHUNKS = 16
+# Redraw download progress at most this often (seconds)
+UPDATE_INTERVAL = 1 / 30
+
 BANNER = "\n".join((r" ____                                 ",
                     r"/ ___|  ___ _ __ __ _ _ __   ___ _ __ ",
                     r"\___ \ / __| '__/ _` | '_ \ / _ \ '__|",
@@ -31,13 +56,47 @@ BANNER = "\n".join((r" ____                                 ",
                     r"                     |_|              "))
 
 
-MAIN_BAR_WIDGETS = ['Tasks complete: ',
-                    progressbar.SimpleProgress(),
-                    ' (', progressbar.Percentage(), ') ',
-                    progressbar.AnimatedMarker()]
-SUB_BAR_WIDGETS = [': ',
-                   ' (', progressbar.Percentage(), ') ',
-                   progressbar.Bar(), progressbar.FileTransferSpeed()]
+MARKERS = '|/-\\'
+SPEED_PREFIXES = ' kMGTPEZY'
+
+def human_speed(pbar):
+    """Format the transfer speed of a progress bar, as progressbar's FileTransferSpeed does"""
+    if pbar.seconds_elapsed < 2e-6 or pbar.currval < 2e-6:
+        scaled = power = 0
+    else:
+        speed = pbar.currval / pbar.seconds_elapsed
+        power = int(math.log(speed, 1000))
+        scaled = speed / 1000. ** power
+    return '%6.2f %sB/s' % (scaled, SPEED_PREFIXES[power])
+
+class MainBarWidget(progressbar.Widget):  # pylint: disable=too-few-public-methods
+    """Renders the whole main bar line with a single format"""
+    def __init__(self):
+        self._curmark = -1
+
+    def update(self, pbar):
+        """Render the line"""
+        if pbar.finished:
+            marker = MARKERS[0]
+        else:
+            self._curmark = (self._curmark + 1) % len(MARKERS)
+            marker = MARKERS[self._curmark]
+        return '%sTasks complete: %d of %d (%3d%%) %s' % (
+            BOLD, pbar.currval, pbar.maxval, pbar.percentage(), marker)
+
+class SubBarWidget(progressbar.WidgetHFill):  # pylint: disable=too-few-public-methods
+    """Renders the whole sub bar line with a single format, the bar fills the width left"""
+    def __init__(self, label):
+        self._label = label
+
+    def update(self, pbar, width):
+        """Render the line to the given width"""
+        percentage = pbar.percentage()
+        head = '%s:  (%3d%%) ' % (self._label, percentage)
+        tail = human_speed(pbar)
+        bar_width = max(width - len(head) - len(tail) - 2, 0)
+        marked = '#' * int(percentage * bar_width / 100)
+        return '%s%s|%s|%s' % (YELLOW, head, marked.ljust(bar_width), tail)
 
 
 class ProgressBarManager(object):
@@ -53,117 +112,180 @@ class ProgressBarManager(object):
         self._main_coords = main_coords if main_coords else self.DEFAULT_COORDS
         self._sub_coords = (main_coords[0] + self.SUB_INDENT, main_coords[1] + self.SUB_LINE_OFFSET)
         self._lines = [None,] * (lines if lines else self.DEFAULT_LINE_MAX)
+        self._free = set(range(len(self._lines)))
+        # Shared sink for sub bars that don't get a slot
+        self._devnull = open(os.devnull, 'w')
+
+    def close(self):
+        """Release resources held by the manager"""
+        self._devnull.close()
 
     def _get_sub_line(self, idx):
         return (self._sub_coords[0], self._sub_coords[1] + idx)
 
     def _alloc_slot(self):
-        if None in self._lines:
-            return self._lines.index(None)
-        return None
+        return self._free.pop() if self._free else None
 
     def _free_slot(self, slot):
         self._lines[slot] = None
+        self._free.add(slot)
 
     @contextmanager
     def install_main(self, progress_bar):
         """Context manager for starting and positioning main progress bar"""
         # Replace writer
         progress_bar.fd = Writer(self._main_coords)
-        # Make bold
-        progress_bar.widgets = [TERM.bold,] + progress_bar.widgets
+        progress_bar.widgets = [MainBarWidget()]
         progress_bar.start()
-        yield progress_bar
-        progress_bar.finish()
+        try:
+            yield progress_bar
+        finally:
+            progress_bar.finish()
 
     @contextmanager
-    def install_sub_bar(self, progress_bar):
-        """Context manager for starting and positioning sub progress bars"""
+    def install_sub_bar(self, progress_bar, label):
+        """Context manager for starting and positioning labeled sub progress bars"""
         # Request a free slot
         slot = self._alloc_slot()
-        if slot is not None:
-            self._lines[slot] = progress_bar
-            # Add line widgets
-            progress_bar.widgets = ["%d: " % slot,] + progress_bar.widgets
-            # Replace writer
-            progress_bar.fd = Writer(self._get_sub_line(slot))
-        else:
-            # If no slots are free, redirect to /dev/null
-            progress_bar.fd = open(os.devnull, 'w')
-        # Make yellow
-        progress_bar.widgets = [TERM.yellow, ] + progress_bar.widgets
-        progress_bar.start()
-        yield progress_bar
-        progress_bar.finish()
-        # Free the slot
-        if slot is not None:
-            self._free_slot(slot)
+        try:
+            if slot is not None:
+                self._lines[slot] = progress_bar
+                # Prefix label with the line number
+                label = "%d: %s" % (slot, label)
+                # Replace writer
+                progress_bar.fd = Writer(self._get_sub_line(slot))
+            else:
+                # If no slots are free, redirect to /dev/null
+                progress_bar.fd = self._devnull
+            progress_bar.widgets = [SubBarWidget(label)]
+            progress_bar.start()
+            try:
+                yield progress_bar
+            finally:
+                progress_bar.finish()
+        finally:
+            # Free the slot, also when the task using the bar failed
+            if slot is not None:
+                self._free_slot(slot)
 
 def bound_concurrency(size):
     """Decorator to limit concurrency on coroutine calls"""
-    sem = asyncio.Semaphore(size)
     def decorator(func):
         """Actual decorator"""
+        # The semaphore is created lazily so it belongs to the loop that runs the calls
+        sem_loop = None
+        sem = None
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
             """Wrapper"""
+            nonlocal sem_loop, sem
+            loop = asyncio.get_running_loop()
+            if sem_loop is not loop:
+                sem_loop, sem = loop, asyncio.Semaphore(size)
             async with sem:
                 return await func(*args, **kwargs)
         return wrapper
     return decorator
 
+def _preallocate(fileno, size):
+    """Reserve size bytes for the file, where the platform and filesystem allow it"""
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fileno, 0, size)
+    except OSError as exc:
+        LOGGER.debug("Could not preallocate %d bytes - %r", size, exc)
+
+def _disposition_filename(content_dispo):
+    """Return the filename from a Content-Disposition header, stripped of any directories"""
+    message = email.message.Message()
+    message['Content-Disposition'] = content_dispo
+    filename = os.path.basename(message.get_filename() or '')
+    # Never let the server name a path outside the output folder
+    return filename if filename not in ('.', '..') else ''
+
+def _write_all(fileno, data):
+    """Write all of data to the file descriptor, retrying on short writes"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fileno, view):]
+
 # Bind concurrency at 10 executions
 @bound_concurrency(10)
-async def download_file(url, output_folder):
-    """Download a file at url to the output path"""
+async def download_file(session, url, output_folder):
+    """Download a file at url to the output path using the given session"""
     try:
         LOGGER.debug("Downloading file from uri: %r to folder: %r", url, output_folder)
-        async with aiohttp.ClientSession() as session:
-            # Request the file
-            resp = await session.get(url)
+        # Request the file
+        async with session.get(url, raise_for_status=True) as resp:
             # Extract the basename, for cases where the filename is unknown
             basename = os.path.basename(url)
             # Attempt to extract file name from the Content-Disposition header
             content_dispo = resp.headers.get('Content-Disposition', None)
+            # If the content disposition is not available, just use the basename from the url
+            filename = basename
             if content_dispo:
                 # Parse disposition and extract filename
-                _, params = cgi.parse_header(content_dispo)
-                filename = params.get('filename')
+                filename = _disposition_filename(content_dispo) or basename
                 LOGGER.debug("Got filename %r for basename %r", filename, basename)
-            else:
-                # If the content disposition is not available, just use the basename from the url
-                filename = basename
             # Attempt to get the file size from the Content-Length header
             content_length = resp.headers.get('Content-Length', None)
             file_size = int(content_length) if content_length else None
-            # Create output file
-            async with aiofiles.open(pathlib.Path(output_folder, filename), "wb") as output_file:
+            # Create output file, writing straight to the descriptor - chunks are already
+            # CHUNK_SIZE so a userspace buffer would only add a copy
+            output_fd = os.open(pathlib.Path(output_folder, filename),
+                                os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                if file_size:
+                    _preallocate(output_fd, file_size)
                 # Create progress bar for this file
-                chunks_bar = progressbar.ProgressBar(
-                    widgets=[filename,] + SUB_BAR_WIDGETS,
-                    maxval=file_size)
+                chunks_bar = progressbar.ProgressBar(maxval=file_size)
                 chunks_bar.term_width = int(chunks_bar.term_width * 0.6)
                 # Install to sub progress bar
-                with PROGRESS_MANAGER.install_sub_bar(chunks_bar):
-                    # Iterate over chunks and write them to file
-                    async for chunk, _ in resp.content.iter_chunks():
-                        if file_size:
-                            # If we have the file size, update the file
-                            chunks_bar.update(chunks_bar.currval + len(chunk))
-                        await output_file.write(chunk)
+                with PROGRESS_MANAGER.install_sub_bar(chunks_bar, filename):
+                    chunk_count = 0
+                    # Iterate over chunks and write them to file, the size is known up front so
+                    # only the sized variant of the loop keeps progress bookkeeping
+                    if file_size:
+                        loop = asyncio.get_running_loop()
+                        next_update_t = 0.0
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            _write_all(output_fd, chunk)
+                            # Update the bar from the file offset - throttled to bound redraws
+                            now = loop.time()
+                            if now >= next_update_t:
+                                chunks_bar.update(os.lseek(output_fd, 0, os.SEEK_CUR))
+                                next_update_t = now + UPDATE_INTERVAL
+                            chunk_count += 1
+                            if chunk_count % YIELD_EVERY_CHUNKS == 0:
+                                # Writes don't suspend, let other downloads run
+                                await asyncio.sleep(0)
+                    else:
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            _write_all(output_fd, chunk)
+                            chunk_count += 1
+                            if chunk_count % YIELD_EVERY_CHUNKS == 0:
+                                await asyncio.sleep(0)
+            finally:
+                try:
+                    # Drop any preallocated tail past the data actually written, so a
+                    # download that stopped early doesn't look complete
+                    os.ftruncate(output_fd, os.lseek(output_fd, 0, os.SEEK_CUR))
+                finally:
+                    os.close(output_fd)
     except (aiohttp.client_exceptions.ClientError, asyncio.TimeoutError) as exc:
         LOGGER.error("Could not download file %r - %r", url, exc)
     except OSError as exc:
         LOGGER.error("Could not write file - %r", exc)
 
-async def fetch(url):
-    """Fetch a page and return the response"""
-    async with aiohttp.ClientSession() as session:
-        LOGGER.debug("Fetching url %r", url)
-        resp = await session.get(url)
+async def fetch(session, url):
+    """Fetch a page using the given session and return the response body and its charset"""
+    LOGGER.debug("Fetching url %r", url)
+    async with session.get(url, raise_for_status=True) as resp:
         LOGGER.debug("Got response, status %d", resp.status)
-        resp.raise_for_status()
-        return await resp.text()
+        # Leave decoding to the parser, it handles XML declarations and meta charsets.
+        # A charset declared in Content-Type is passed along so it still takes precedence
+        return await resp.read(), resp.charset
 
 # pylint: disable=too-few-public-methods
 class Writer(object):
@@ -175,41 +297,92 @@ class Writer(object):
     def __init__(self, location):
         """Input: location - tuple of ints (x, y), the position of the bar in the terminal"""
         self.location = location
+        # Precompute the escapes TERM.location would emit, it takes (y, x) for move
+        self._prefix = TERM.save + TERM.move(location[1], location[0])
+        self._suffix = TERM.restore
     def write(self, string):
         """Write with saved location"""
-        with TERM.location(*self.location):
-            print(string)
+        sys.stdout.write(self._prefix + string + '\n' + self._suffix)
+        sys.stdout.flush()
+
+def extract_zip_links(page, charset=None):
+    """Return the targets of all zip file links in the raw page, decoded as charset if given"""
+    if HAVE_LXML:
+        try:
+            doc = lxml.html.fromstring(page, parser=lxml.html.HTMLParser(encoding=charset))
+        except lxml.etree.ParserError as exc:
+            # e.g. an empty page, which just has no links
+            LOGGER.error("Could not parse page - %r", exc)
+            return []
+        return doc.xpath("//a[substring(@href, string-length(@href) - 3) = '.zip']/@href")
+    # pylint: disable=import-outside-toplevel
+    from bs4 import BeautifulSoup
+    from bs4 import SoupStrainer
+    # Only build nodes for anchors with a target, so the soup holds just those
+    soup = BeautifulSoup(page, 'html.parser', parse_only=SoupStrainer('a', href=True),
+                         from_encoding=charset)
+    return [anchor['href'] for anchor in soup if anchor['href'].endswith('.zip')]
 
 async def scrape(output_dir):
     """Scrape"""
+    # Share one connection pool between the page fetch and the downloads
+    connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, ttl_dns_cache=DNS_CACHE_TTL)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await _scrape(session, output_dir)
+
+async def _scrape(session, output_dir):
+    """Scrape using the given session"""
     url = "http://speedtest.tele2.net/"
     try:
-        resp_text = await fetch(url)
+        page, charset = await fetch(session, url)
     except (aiohttp.client_exceptions.ClientError, asyncio.TimeoutError) as exc:
         LOGGER.error("Could not fetch page - %r", exc)
         return
-    # Make soup
-    LOGGER.info("Extracting 100MB link")
-    soup = BeautifulSoup(resp_text, 'html.parser')
-    # Filter all links according to their target's prefix.
-    all_files = list(filter(lambda element: element.attrs.get('href', '').endswith('.zip'),
-                            soup.findAll("a", href=True)))
-    LOGGER.info("Got %d zip links", len(all_files))
-
-    all_urls = map(lambda element: element.attrs['href'], all_files)
-    target_url = list(filter(lambda href: href.startswith("100MB"), all_urls))[0]
-    coros_bar = progressbar.ProgressBar(
-        widgets=MAIN_BAR_WIDGETS,
-        maxval=1)
+    # Parse page and select zip links
+    LOGGER.info("Extracting zip links")
+    hrefs = extract_zip_links(page, charset)
+    LOGGER.info("Got %d zip links", len(hrefs))
+    prefixes = tuple(FLAGS.file_prefixes)
+    target_urls = [href for href in hrefs if href.startswith(prefixes)] if prefixes else hrefs
+    # Drop duplicate links, concurrent downloads of one file would write the same path
+    target_urls = list(dict.fromkeys(target_urls))
+    if not target_urls:
+        LOGGER.error("No matching zip links")
+        return
+    LOGGER.info("Downloading %d files", len(target_urls))
+    coros_bar = progressbar.ProgressBar(maxval=len(target_urls))
     coros_bar.term_width = int(coros_bar.term_width * 0.6)
 
+    async def download_and_count(file_url):
+        """Download a file and advance the main bar once it is done"""
+        try:
+            return await download_file(session, file_url, output_dir)
+        finally:
+            coros_bar.update(coros_bar.currval + 1)
+
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
     with PROGRESS_MANAGER.install_main(coros_bar):
-        await download_file(url + target_url, output_dir)
+        results = await asyncio.gather(
+            *(download_and_count(url + target_url) for target_url in target_urls),
+            return_exceptions=True)
+    for target_url, result in zip(target_urls, results):
+        if isinstance(result, Exception):
+            LOGGER.error("Download of %r failed - %r", target_url, result)
 
 def print_banner():
     """Print the colorful blinking banner"""
-    print(TERM.magenta + TERM.blink + TERM.bold + BANNER + TERM.normal)
+    print(MAGENTA + BLINK + BOLD + BANNER + NORMAL)
+
+def run(coro):
+    """Run a coroutine to completion, preferring the libuv based event loop when available"""
+    if uvloop is None:
+        return asyncio.run(coro)
+    if hasattr(asyncio, 'Runner'):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coro)
+    # Older interpreters can only pick the loop through the deprecated policy system
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coro)
 
 def main(_):
     """Main function"""
@@ -223,10 +396,14 @@ def main(_):
         print_banner()
         # Start work
         print("\nStarting...")
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(scrape(FLAGS.output_dir))
+        try:
+            run(scrape(FLAGS.output_dir))
+        finally:
+            PROGRESS_MANAGER.close()
 
 TERM = blessings.Terminal()
+# Resolve formatting sequences once instead of on every attribute access
+BOLD, YELLOW, MAGENTA, BLINK, NORMAL = TERM.bold, TERM.yellow, TERM.magenta, TERM.blink, TERM.normal
 PROGRESS_MANAGER = None
 LOGGER = logging.get_absl_logger()
 